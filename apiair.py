@@ -13,10 +13,21 @@ import pandas
 import tinydb
 from version import version
 import colorutils
-from flask import Flask, jsonify, request
+from flask import Flask, request
+from werkzeug.routing import FloatConverter
 from flask.ext.autodoc import Autodoc
-from simplecrypt import decrypt
+from simplecrypt import decrypt, DecryptionException
 from geopy.distance import vincenty
+from libapiair import iter_chunks, iter_b64decode, iter_decrypt, save_stream
+from libapiair import ProfilerMiddleware
+from libapiair import LondonAirQuality, londoncolor, sitetypes
+from libapiair import Limiter, Unavailable
+from libapiair import dumps, RawJSON
+
+
+class SignedFloatConverter(FloatConverter):
+    """Float in URL with an optional minus sign (e.g. longitude west of Greenwich)."""
+    regex = r'-?\d+(?:\.\d+)?'
 
 
 # Dossier des données
@@ -24,15 +35,46 @@ datadir = os.environ.get('OPENSHIFT_DATA_DIR', '.')
 
 # Application Flask
 app = Flask('apiair')
+app.url_map.converters['sfloat'] = SignedFloatConverter
 autodoc = Autodoc(app)  # Autodoc extension
 
 # Stockage des données
 fndb = os.path.join(datadir, '{region}_iqa.json')  # iqa, last hour
 fndat = os.path.join(datadir, '{region}_conc.dat')  # conc, last two days
+concs_cache = dict()  # conc, data read from files
 
 # Clé via variable d'environnement
 key = os.environ['APIAIR_KEY']
 
+# Profilage des requêtes (opérateur), via variables d'environnement :
+#  - APIAIR_PROFILE_KEY : valeur de l'en-tête 'X-Apiair-Profile' pour profiler une requête
+#  - APIAIR_PROFILE_SLOW : durée (s) au-delà de laquelle une requête échantillonnée est sauvegardée
+#  - APIAIR_PROFILE_SAMPLE : fraction des requêtes échantillonnées (défaut 0.01, soit 1 %,
+#    cProfile ralentit fortement les requêtes profilées)
+#  - APIAIR_PROFILE_MAX : nombre de profils conservés (défaut 20, au moins 1)
+profile_key = os.environ.get('APIAIR_PROFILE_KEY')
+profile_slow = os.environ.get('APIAIR_PROFILE_SLOW')
+if profile_key or profile_slow:
+    app.wsgi_app = ProfilerMiddleware(
+        app.wsgi_app,
+        directory=os.path.join(datadir, 'profiles'),
+        secret=profile_key,
+        threshold=float(profile_slow) if profile_slow else None,
+        sample=float(os.environ.get('APIAIR_PROFILE_SAMPLE', 0.01)),
+        maxprofiles=int(os.environ.get('APIAIR_PROFILE_MAX', 20)))
+
+# Nombre de requêtes simultanées (par processus) des routes coûteuses, au-delà
+# la requête est rejetée (503) pour ne pas bloquer les routes peu coûteuses.
+# Les limites sont comptées par processus : elles n'ont d'effet qu'avec des
+# workers multi-threads (ex. mod_wsgi threads=N, gunicorn --threads N). Avec des
+# workers mono-thread (app.run, gunicorn sync), une limite n'est jamais atteinte.
+limit_conc = Limiter('conc', int(os.environ.get('APIAIR_LIMIT_CONC', 4)))
+limit_post = Limiter('post', int(os.environ.get('APIAIR_LIMIT_POST', 2)))
+limit_london = Limiter('london', int(os.environ.get('APIAIR_LIMIT_LONDON', 4)))  # lecture et requêtes sur la table
+
+# Délai maximal (s) des appels à l'API London Air Quality
+london_timeout = float(os.environ.get('APIAIR_LONDON_TIMEOUT', 5))
+
 
 def strip_with_indent(s):
     """Remove extra space in code.
@@ -133,6 +175,66 @@ def colorize(v, param):
             return colorhex_to_rgb(color)
 
 
+def split_zonetypo(zonetypo):
+    """Split a zone and iqa string like 'zone1-typo1'.
+
+    :param zonetypo: string.
+    :return: (zone, typo), zone is '' if missing (e.g. 'urb').
+    """
+    zonetypo = zonetypo.strip()
+    if re.match(r'^[-+]?[\d.]+$', zonetypo):
+        raise ValueError("'{}' is not a zone (use zone-typo, or lon,lat for geolocation)".format(zonetypo))
+    zone, _, typo = zonetypo.rpartition('-')
+    return zone, typo
+
+
+def json_response(obj):
+    """JSON response, NumPy arrays and NaN are encoded directly (see libapiair.dumps).
+
+    :param obj: data.
+    :return: flask.Response.
+    """
+    return app.response_class(dumps(obj), mimetype='application/json')
+
+
+def read_conc(region):
+    """Read air quality data from local file.
+
+    Data is read again only if the file has changed, the index (dates) is
+    encoded in JSON once and shared by all requests.
+
+    :param region: name of region.
+    :return: (pandas.DataFrame, RawJSON of index).
+    """
+    fn = fndat.format(region=region)
+    st = os.stat(fn)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = concs_cache.get(fn)
+    if cached is None or cached[0] != stamp:
+        dat = pandas.read_csv(fn)
+        cached = (stamp, dat, RawJSON(dumps(dat['dh'])))
+        concs_cache[fn] = cached
+    return cached[1:]
+
+
+@app.errorhandler(Unavailable)
+def unavailable(e):
+    """Server busy or dependency unavailable."""
+    response = json_response(dict(status='error', message=str(e)))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def london_response(laq, **kwargs):
+    """JSON response with the age of London bulletin (Age header)."""
+    response = json_response(kwargs)
+    age = laq.get_age()
+    if age is not None:
+        response.headers['Age'] = str(max(int(age), 0))
+    return response
+
+
 @app.route('/')
 @autodoc.doc()
 def index():
@@ -146,10 +248,11 @@ def index():
     }
     ..
     """
-    return jsonify(dict(status='ok', version=version))
+    return json_response(dict(status='ok', version=version))
 
 
 @app.route('/post/iqa/<region>', methods=['POST'])
+@limit_post
 def post_iqa(region):
     """Save last air quality information (index, color) into database.
 
@@ -177,21 +280,46 @@ def post_iqa(region):
                     db.insert(dict(zone=zone, typo=typo, pol=pol, val=val, iqa=iqa))
                     inserted += 1
 
-    return jsonify(dict(status='ok', inserted=inserted, updated=updated))
+    return json_response(dict(status='ok', inserted=inserted, updated=updated))
 
 
 @app.route('/post/conc/<region>', methods=['POST'])
+@limit_post
 def post_conc(region):
     """Save air quality data into local file.
 
+    Data (encrypted then base64 encoded) is sent either in the 'data' field
+    of a form, or as the raw body of the request with the content type
+    'application/octet-stream'. The raw body is decoded and decrypted on the
+    fly, so memory usage does not depend on the size of data.
+
+    A chunked body (no Content-Length) is read only if the WSGI server sets
+    'wsgi.input_terminated', otherwise the request is rejected (411).
+
     :param region: name of region.
     """
+    if request.mimetype == 'application/octet-stream':
+        if request.content_length is not None:
+            stream = request.stream
+        elif request.environ.get('wsgi.input_terminated'):
+            stream = request.environ['wsgi.input']  # chunked body, EOF is the end of body
+        else:
+            return json_response(dict(status='error', message=(
+                "chunked body not supported by the server, "
+                "send the body with a Content-Length"))), 411
+        chunks = iter_decrypt(key, iter_b64decode(iter_chunks(stream)))
+        try:
+            nlines = save_stream(fndat.format(region=region), chunks)
+        except (ValueError, DecryptionException) as e:
+            return json_response(dict(status='error', message=str(e))), 400
+        return json_response(dict(status='ok', rows=max(nlines - 1, 0)))
+
     encstr = request.form['data']
 
     with open(fndat.format(region=region), 'w') as f:
         f.write(decrypt(key, base64.b64decode(encstr)).decode('utf-8'))
 
-    return jsonify(dict(status='ok'))
+    return json_response(dict(status='ok'))
 
 
 @app.route('/get/iqa/random')
@@ -215,7 +343,7 @@ def get_iqa_random():
     h, s, v = random.randint(0, 359), 1.0, 1.0
     c = colorutils.Color(hsv=(h, s, v))
     r, g, b = [int(e) for e in c.rgb]
-    return jsonify(dict(color=[r, g, b]))
+    return json_response(dict(color=[r, g, b]))
 
 
 @app.route('/get/iqa/<region>/<listzoneiqa>')
@@ -259,26 +387,42 @@ def get_iqa_listzoneiqa(region, listzoneiqa):
     ..
 
     """
-    # Special case with London (with no colors)
-    # /get/iqa/london/urb,trf
+    # Special case with London (index from 1 to 10, 0 if no data, no concentrations)
+    # /get/iqa/london/cityoflondon-urb,westminster-trf
+    # /get/iqa/london/urb,trf (City of London)
     if region == 'london':
-        from libapiair import LondonAirQuality, londoncolor
-        laq = LondonAirQuality()
-        iqas = laq.get_hourly_air_quality_index('cityoflondon')
-        print(iqas)
-        colors = [londoncolor(iqa) for iqa in iqas]
-        return jsonify(dict(iqa=iqas, color=colors))
+        with limit_london:
+            laq = LondonAirQuality(timeout=london_timeout)
+            table = laq.read_hourly_air_quality_index()  # call API only if needed
+            iqas = list()
+            for zonetypo in listzoneiqa.strip().split(','):
+                try:
+                    zone, typo = split_zonetypo(zonetypo)
+                except ValueError as e:
+                    return json_response(dict(status='error: {}'.format(e))), 400
+                if typo not in sitetypes:
+                    return json_response(dict(status='error: cannot find typo={typo}'.format(**locals()))), 400
+                zone = zone or 'cityoflondon'
+                if laq.get_sites(zone, table=table).empty:
+                    return json_response(dict(status='error: cannot find zone={zone}'.format(**locals()))), 400
+                # No site of this type with data for this hour: 0 (no color), as before
+                iqas.append(laq.get_max_index(zone, typo, table=table) or 0)
+            colors = [londoncolor(iqa) for iqa in iqas]
+            return london_response(laq, iqa=iqas, color=colors)
 
     db = tinydb.TinyDB(fndb.format(region=region), default_table='air')
     q = tinydb.Query()
 
     iqas, colors, concs = list(), list(), list()
     for zonetypo in listzoneiqa.strip().split(','):
-        zone, typo = zonetypo.strip().split('-')
+        try:
+            zone, typo = split_zonetypo(zonetypo)
+        except ValueError as e:
+            return json_response(dict(status='error: {}'.format(e))), 400
         enr = db.search((q.zone == zone) & (q.typo == typo))
 
         if not enr:
-            return jsonify(
+            return json_response(
                 dict(status='error: cannot find data for zone={zone} and typo={typo}'.format(
                     **locals()))), 400
 
@@ -293,10 +437,10 @@ def get_iqa_listzoneiqa(region, listzoneiqa):
         colors.append(colorize(iqa, param='iqa'))
         concs.append(conc)
 
-    return jsonify(dict(iqa=iqas, color=colors, concentrations=concs))
+    return json_response(dict(iqa=iqas, color=colors, concentrations=concs))
 
 
-@app.route('/get/iqa/<region>/<float:lon>,<float:lat>')
+@app.route('/get/iqa/<region>/<sfloat:lon>,<sfloat:lat>')
 @autodoc.doc()
 def get_iqa_geoloc(region, lon, lat):
     """Get latest air quality information (index, color, concentrations)
@@ -306,9 +450,10 @@ def get_iqa_geoloc(region, lon, lat):
     :param lon: longitude (degrees).
     :param lat: latitude (degrees).
 
-    Example of use:
+    Examples of use:
     ..
         /get/iqa/paca/5.6375,43.6377
+        /get/iqa/london/-0.09,51.51
     ..
 
     Response in JSON format:
@@ -330,6 +475,17 @@ def get_iqa_geoloc(region, lon, lat):
     }
     ..
     """
+    # London: nearest monitoring site
+    if region == 'london':
+        with limit_london:
+            laq = LondonAirQuality(timeout=london_timeout)
+            table = laq.read_hourly_air_quality_index()  # call API only if needed
+            site = laq.get_nearest_site(lon, lat, table=table)
+            if site is None:
+                return json_response(dict(status='error: cannot find data')), 400
+            iqa = int(site['iqa'])
+            return london_response(laq, iqa=[iqa], color=[londoncolor(iqa)], sitecode=[site.name])
+
     # FIXME: this is a testing function.
 
     aix = (5.454025, 43.531127)
@@ -347,6 +503,7 @@ def get_iqa_geoloc(region, lon, lat):
 
 @app.route('/get/conc/<region>/<listmesures>')
 @autodoc.doc()
+@limit_conc
 def get_conc_listmesures(region, listmesures):
     """Get air quality data.
 
@@ -384,17 +541,16 @@ def get_conc_listmesures(region, listmesures):
     listmesures = listmesures.strip().split(',')
 
     # Read data from local file
-    dat = pandas.read_csv(fndat.format(region=region))
+    dat, idx = read_conc(region)
 
-    idx = dat['dh'].tolist()
     extr = dict()
 
     for mes in listmesures:
         if mes not in dat:
-            return jsonify(dict(status='error', message="cannot find '{}' measure !".format(mes))), 400
-        extr[mes] = dat[mes].tolist()
+            return json_response(dict(status='error', message="cannot find '{}' measure !".format(mes))), 400
+        extr[mes] = dat[mes].values
 
-    return jsonify(dict(status='ok', index=idx, data=extr))
+    return json_response(dict(status='ok', index=idx, data=extr))
 
 
 @app.route('/doc')
@@ -4,4 +4,8 @@
 """apiair."""
 
 
-from libapiair.london import LondonAirQuality, londoncolor
+from libapiair.london import LondonAirQuality, londoncolor, boroughname, sitetypes
+from libapiair.ingest import iter_chunks, iter_b64decode, iter_decrypt, save_stream
+from libapiair.profiling import ProfilerMiddleware
+from libapiair.admission import Limiter, Unavailable
+from libapiair.serialize import dumps, RawJSON
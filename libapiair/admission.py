@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Admission control (concurrency limits)."""
+
+
+import functools
+import threading
+
+
+class Unavailable(Exception):
+    """Request rejected: server busy or dependency unavailable (HTTP 503)."""
+
+
+class Limiter(object):
+    """Limit the number of concurrent calls, reject the others at once.
+
+    Use it as a decorator or as a context manager:
+    ..
+        limit = Limiter('conc', 4)
+
+        @limit
+        def f():
+            ...
+
+        with limit:
+            ...
+    ..
+
+    The count is kept by process (threading semaphore): it only limits
+    concurrent requests served by the threads of one worker. With single
+    threaded workers, the limit is never reached.
+    """
+
+    def __init__(self, name, size):
+        """Constructor.
+
+        :param name: name of limiter (used in error message).
+        :param size: max number of concurrent calls (by process).
+        """
+        self.name = name
+        self.size = size
+        self._sem = threading.BoundedSemaphore(size)
+
+    def __enter__(self):
+        if not self._sem.acquire(blocking=False):
+            raise Unavailable("server busy ({}), retry later".format(self.name))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._sem.release()
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
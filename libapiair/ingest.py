@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Streaming ingest of encrypted data (bounded memory)."""
+
+
+import os
+import stat
+import base64
+import binascii
+import codecs
+import hmac
+import tempfile
+import simplecrypt
+from simplecrypt import DecryptionException
+from Crypto.Cipher import AES
+from Crypto.Hash import HMAC
+from Crypto.Util import Counter
+
+
+# Taille des blocs lus depuis le corps de la requête
+chunksize = 64 * 1024
+
+
+def iter_chunks(stream, size=chunksize):
+    """Read a file-like object by chunks.
+
+    :param stream: file-like object (e.g. request.stream).
+    :param size: size of chunks (bytes).
+    :return: iterator of bytes.
+    """
+    return iter(lambda: stream.read(size), b'')
+
+
+def iter_b64decode(chunks):
+    """Decode base64 data chunk by chunk.
+
+    :param chunks: iterator of base64 encoded bytes.
+    :return: iterator of decoded bytes.
+    """
+    rest = b''
+    for chunk in chunks:
+        buf = rest + b''.join(chunk.split())  # remove whitespace and newlines
+        n = len(buf) - len(buf) % 4  # base64 works with groups of 4 chars
+        rest = buf[n:]
+        if n:
+            try:
+                yield base64.b64decode(buf[:n], validate=True)
+            except binascii.Error as e:
+                raise ValueError("invalid base64 data: {}".format(e))
+    if rest:
+        raise ValueError("invalid base64 data: truncated input")
+
+
+def iter_decrypt(password, chunks):
+    """Decrypt data encrypted with simplecrypt.encrypt, chunk by chunk.
+
+    Same format as simplecrypt (header, salt, AES-CTR data, HMAC) but the
+    data is never fully loaded in memory. The HMAC is only checked at the
+    end: the caller must not trust the output before the iterator is exhausted.
+
+    :param password: password used with simplecrypt.encrypt.
+    :param chunks: iterator of encrypted bytes.
+    :return: iterator of decrypted bytes.
+    """
+    chunks = iter(chunks)
+    buf = bytearray()
+
+    def fill(n):
+        while len(buf) < n:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise DecryptionException('Missing data.')
+            buf.extend(chunk)
+
+    # Header and salt
+    nhdr = len(simplecrypt.HEADER[simplecrypt.LATEST])
+    fill(nhdr)
+    header = bytes(buf[:nhdr])
+    if header not in simplecrypt.HEADER:
+        raise DecryptionException('Bad data format.')
+    version = simplecrypt.HEADER.index(header)
+    nsalt = simplecrypt.SALT_LEN[version] // 8
+    fill(nhdr + nsalt)
+    salt = bytes(buf[nhdr:nhdr + nsalt])
+
+    hmac_key, cipher_key = simplecrypt._expand_keys(password, salt, simplecrypt.EXPANSION_COUNT[version])
+    mac = HMAC.new(hmac_key, bytes(buf[:nhdr + nsalt]), simplecrypt.HASH)
+    counter = Counter.new(simplecrypt.HALF_BLOCK, prefix=salt[:simplecrypt.HALF_BLOCK // 8])
+    cipher = AES.new(cipher_key, AES.MODE_CTR, counter=counter)
+    del buf[:nhdr + nsalt]
+
+    # Encrypted data, always keep the trailing HMAC into the buffer
+    ndigest = simplecrypt.HASH.digest_size
+    for chunk in chunks:
+        buf.extend(chunk)
+        n = (len(buf) - ndigest) // AES.block_size * AES.block_size
+        if n > 0:
+            data = bytes(buf[:n])
+            del buf[:n]
+            mac.update(data)
+            yield cipher.decrypt(data)
+
+    if len(buf) < ndigest:
+        raise DecryptionException('Missing data.')
+    data = bytes(buf[:-ndigest])
+    if data:
+        mac.update(data)
+        yield cipher.decrypt(data)
+    if not hmac.compare_digest(mac.digest(), bytes(buf[-ndigest:])):
+        raise DecryptionException('Bad password or corrupt / modified data.')
+
+
+def _file_mode(filename):
+    """Return the mode of an existing file, or the default mode of a new one (umask)."""
+    try:
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)  # no way to read the umask without setting it
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def save_stream(filename, chunks, encoding='utf-8'):
+    """Save text data into a file, chunk by chunk.
+
+    Data is written into a temporary file which replaces the destination
+    file only once all chunks were read without error. All chunks are read
+    before an encoding error is raised, so that an error of the iterator
+    (e.g. bad HMAC in iter_decrypt) takes precedence.
+
+    :param filename: destination file.
+    :param chunks: iterator of encoded bytes.
+    :param encoding: encoding of data.
+    :return: number of lines written.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    nlines, error = 0, None
+
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                if error is None:
+                    try:
+                        nlines += decoder.decode(chunk).count('\n')
+                    except UnicodeDecodeError as e:
+                        error = e
+            if error is None:
+                try:
+                    decoder.decode(b'', final=True)
+                except UnicodeDecodeError as e:
+                    error = e
+        if error is not None:
+            raise error
+        os.chmod(tmpname, _file_mode(filename))  # mkstemp creates the file with mode 0600
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+    return nlines
+
+
+if __name__ == '__main__':
+
+    # Testing code: check iter_decrypt against simplecrypt
+
+    import shutil
+
+    password = 'apiair'
+    data = ''.join('2016-09-07 {:02d}:00:00,{},{}\n'.format(h % 24, h, h * 1.5) for h in range(1000)).encode('utf-8')
+    enc = simplecrypt.encrypt(password, data)
+    assert simplecrypt.decrypt(password, enc) == data
+
+    def split(b, cuts):
+        """Split bytes at given positions."""
+        cuts = [0] + sorted(c for c in cuts if 0 < c < len(b)) + [len(b)]
+        return [b[i:j] for i, j in zip(cuts[:-1], cuts[1:])]
+
+    # Cut inside header, salt, data and HMAC
+    ndigest = simplecrypt.HASH.digest_size
+    cuts = [1, 3, 5, 20, 35, 37, 100, 101, len(enc) - ndigest - 1, len(enc) - ndigest + 3, len(enc) - 1]
+    for chunks in (split(enc, cuts), [enc], [bytes([e]) for e in enc]):
+        assert b''.join(iter_decrypt(password, chunks)) == data
+
+    # Same through base64, with chunks of various size
+    b64 = base64.b64encode(enc)
+    for size in (1, 3, 7, 64, 1000, len(b64)):
+        chunks = [b64[i:i + size] for i in range(0, len(b64), size)]
+        assert b''.join(iter_decrypt(password, iter_b64decode(chunks))) == data
+
+    # Tampered data: error and existing file is not modified
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(tmpdir, 'paca_conc.dat')
+        assert save_stream(fn, iter_decrypt(password, [enc])) == 1000
+        with open(fn, 'rb') as f:
+            assert f.read() == data
+
+        # Same mode as a file created by open(), then mode of existing file is kept
+        with open(os.path.join(tmpdir, 'mode'), 'w'):
+            pass
+        assert os.stat(fn).st_mode == os.stat(os.path.join(tmpdir, 'mode')).st_mode
+        os.remove(os.path.join(tmpdir, 'mode'))
+        os.chmod(fn, 0o640)
+        save_stream(fn, iter_decrypt(password, [enc]))
+        assert stat.S_IMODE(os.stat(fn).st_mode) == 0o640
+        for pos in (2, 10, 100, len(enc) - 1):
+            tampered = bytearray(enc)
+            tampered[pos] ^= 1
+            try:
+                save_stream(fn, iter_decrypt(password, [bytes(tampered)]))
+                raise AssertionError('tampered data accepted')
+            except DecryptionException:
+                pass
+            with open(fn, 'rb') as f:
+                assert f.read() == data
+
+        # Valid data but not UTF-8: error and existing file is not modified
+        try:
+            save_stream(fn, iter_decrypt(password, [simplecrypt.encrypt(password, b'dh\n\xff\n')]))
+            raise AssertionError('bad encoding accepted')
+        except UnicodeDecodeError:
+            pass
+        with open(fn, 'rb') as f:
+            assert f.read() == data
+        assert os.listdir(tmpdir) == ['paca_conc.dat']  # no temporary file left
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('ok')
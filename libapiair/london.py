@@ -5,29 +5,56 @@
 
 
 import io
+import re
+import time
 import datetime
+import threading
 import json
 import requests
+import numpy
 import pandas
+from libapiair.admission import Unavailable
 
 
 class LondonAirQuality(object):
     """London Air Quality."""
 
-    def __init__(self):
+    _hourly = dict()  # hourly index of all London, shared by instances
+    _hourly_cond = threading.Condition()
+
+    def __init__(self, timeout=5., retry=60.):
+        """Constructor.
+
+        :param timeout: time budget of an API call (seconds), from the
+          connection to the end of the response.
+        :param retry: delay before calling again API after a failure (seconds).
+        """
         self.baseurl = "http://api.erg.kcl.ac.uk/AirQuality"
+        self.timeout = timeout
+        self.retry = retry
+
+    def _read(self, apiurl):
+        """Read data from API within the time budget."""
+        deadline = time.time() + self.timeout
+        r = requests.get(self.baseurl + apiurl, timeout=self.timeout, stream=True)
+        try:
+            assert r.status_code == 200
+            content = bytearray()
+            for chunk in r.iter_content(chunk_size=16 * 1024):
+                content.extend(chunk)
+                if time.time() > deadline:
+                    raise requests.Timeout("no complete response after {} s".format(self.timeout))
+        finally:
+            r.close()
+        return bytes(content)
 
     def _read_json(self, apiurl):
         """Read data from API (JSON format)."""
-        r = requests.get(self.baseurl + apiurl)
-        assert r.status_code == 200
-        return json.loads(r.content.decode('utf-8'))
+        return json.loads(self._read(apiurl).decode('utf-8'))
 
     def _read_csv(self, apiurl):
         """Read data from API (CSV format)."""
-        r = requests.get(self.baseurl + apiurl)
-        assert r.status_code == 200
-        s = io.StringIO(r.content.decode('utf-8'))
+        s = io.StringIO(self._read(apiurl).decode('utf-8'))
         return pandas.read_csv(s)
 
     def read_measures(self, sitecode, specie, start, end):
@@ -88,33 +115,203 @@ class LondonAirQuality(object):
                 print(("{now:%Y-%m-%d %H:%M:%S},{bulletindate},{sitecode},"
                        "{sitetype},{pol},{idx}").format(**locals()))
 
-    def get_hourly_air_quality_index(self, groupname):
-        """
+    def read_hourly_air_quality_index(self):
+        """Read the London-wide hourly air quality index.
 
-        :param groupname:
-        :return:
+        The table is shared by all instances and read again from the API
+        while its bulletin is more than one hour old: until the next bulletin
+        is published, the API is called again every 'retry' seconds. The API
+        is called by a background thread: meanwhile, or if the call fails or
+        is out of time budget, the last table is returned at once (see
+        get_age). If there is no table at all, wait for the call during the
+        time budget, then raise Unavailable.
+
+        :return: pandas.DataFrame indexed by site code, with columns borough,
+          sitename, sitetype, lat, lon, bulletin, iqa (max of species) and
+          the index of each specie (NaN if not measured).
         """
-        max_urb, max_trf = 0, 0
+        cache, cond = LondonAirQuality._hourly, LondonAirQuality._hourly_cond
 
-        apiurl = '/Hourly/MonitoringIndex/GroupName={groupname}/Json'.format(**locals())
-        data = self._read_json(apiurl)
-        sites = data['HourlyAirQualityIndex']['LocalAuthority']['Site']
-        for site in sites:
-            sitecode = site['@SiteCode']
-            sitetype = site['@SiteType']
-            bulletindate = site['@BulletinDate']
-            if isinstance(site['Species'], dict):
-                species = [site['Species'], ]
+        with cond:
+            now = time.time()
+            if 'call' in cache and now >= cache['deadline']:
+                # Call out of time budget: abandoned, its result will be ignored
+                cache.update(retry=cache['deadline'] + self.retry, error='timeout')
+                del cache['call']
+            fresh = self.get_age() is not None and self.get_age() < 3600
+            if not fresh and 'call' not in cache and now >= cache.get('retry', 0):
+                # Only one call at a time, in a background thread
+                cache.update(call=object(), deadline=now + self.timeout)
+                threading.Thread(target=self._refresh_hourly, args=(cache['call'], ), daemon=True).start()
+
+            if 'table' in cache:
+                return cache['table']
+
+            # No table: wait for the end of the call, within the time budget
+            if 'call' in cache:
+                call = cache['call']
+                cond.wait_for(lambda: cache.get('call') is not call, timeout=cache['deadline'] - now)
+            if 'table' not in cache:
+                raise Unavailable("London Air Quality API: {}".format(cache.get('error', 'timeout')))
+            return cache['table']
+
+    def _refresh_hourly(self, call):
+        """Call API and update the hourly index table (background thread).
+
+        :param call: token of the call, the result is ignored if the call
+          was abandoned (out of time budget).
+        """
+        try:
+            table = self._parse_hourly_air_quality_index(
+                self._read_json('/Hourly/MonitoringIndex/GroupName=London/Json'))
+            bulletin = pandas.to_datetime(table['bulletin'], errors='coerce').max()
+            if pandas.isnull(bulletin):  # no bulletin date: hour of the call
+                bulletin = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
             else:
-                species = site['Species']
-            for specie in species:
-                pol = specie['@SpeciesCode']
-                idx = int(specie['@AirQualityIndex'])
-                if 'Urban' in sitetype and idx > max_urb:
-                    max_urb = idx
-                elif 'Roadside' in sitetype and idx > max_trf:
-                    max_trf = idx
-        return max_urb, max_trf
+                bulletin = london_to_utc(bulletin.to_pydatetime())
+            # Next bulletin not yet published: call again after 'retry' seconds
+            result = dict(table=table, bulletin=bulletin, retry=time.time() + self.retry)
+        except Exception as e:
+            result = dict(retry=time.time() + self.retry, error=str(e))
+
+        cache, cond = LondonAirQuality._hourly, LondonAirQuality._hourly_cond
+        with cond:
+            if cache.get('call') is call:
+                cache.update(result)
+                del cache['call']
+                cond.notify_all()
+
+    def get_age(self):
+        """Return the age of the bulletin of hourly index table (seconds), None if not read."""
+        if 'bulletin' not in LondonAirQuality._hourly:
+            return None
+        return (datetime.datetime.utcnow() - LondonAirQuality._hourly['bulletin']).total_seconds()
+
+    @staticmethod
+    def _parse_hourly_air_quality_index(data):
+        """Flatten the nested JSON of hourly index into one row per site."""
+        rows = list()
+        for authority in _as_list(data['HourlyAirQualityIndex']['LocalAuthority']):
+            borough = boroughname(authority['@LocalAuthorityName'])
+            for site in _as_list(authority.get('Site')):
+                row = dict(
+                    sitecode=site['@SiteCode'],
+                    sitename=site.get('@SiteName'),
+                    sitetype=site.get('@SiteType', ''),
+                    borough=borough,
+                    lat=_as_float(site.get('@Latitude')),
+                    lon=_as_float(site.get('@Longitude')),
+                    bulletin=site.get('@BulletinDate'))
+                for specie in _as_list(site.get('Species')):
+                    row[specie['@SpeciesCode']] = _as_float(specie['@AirQualityIndex'])
+                rows.append(row)
+
+        columns = ['sitecode', 'sitename', 'sitetype', 'borough', 'lat', 'lon', 'bulletin']
+        df = pandas.DataFrame(rows, columns=columns + sorted({k for row in rows for k in row} - set(columns)))
+        df = df.set_index('sitecode')
+        df['iqa'] = df.drop(columns[1:], axis=1).max(axis=1)
+        return df
+
+    def get_sites(self, borough=None, typo=None, table=None):
+        """Return monitoring sites with their hourly index.
+
+        :param borough: borough name (see boroughname), None for all London.
+        :param typo: 'urb' (urban sites), 'trf' (roadside sites) or None for all.
+        :param table: hourly index table, None to read it.
+        :return: pandas.DataFrame (see read_hourly_air_quality_index).
+        """
+        df = self.read_hourly_air_quality_index() if table is None else table
+        if borough is not None:
+            df = df[df['borough'] == boroughname(borough)]
+        if typo is not None:
+            if typo not in sitetypes:
+                raise ValueError("cannot find typo '%s'" % typo)
+            df = df[df['sitetype'].str.contains(sitetypes[typo])]
+        return df
+
+    def get_max_index(self, borough=None, typo=None, table=None):
+        """Return max of hourly index of monitoring sites.
+
+        :param borough: borough name (see boroughname), None for all London.
+        :param typo: 'urb', 'trf' or None for all.
+        :param table: hourly index table, None to read it.
+        :return: int or None (no data).
+        """
+        iqa = self.get_sites(borough, typo, table)['iqa'].max()
+        if pandas.isnull(iqa):
+            return None
+        return int(iqa)
+
+    def get_nearest_site(self, lon, lat, typo=None, table=None):
+        """Return the nearest monitoring site with hourly index.
+
+        :param lon: longitude (degrees).
+        :param lat: latitude (degrees).
+        :param typo: 'urb', 'trf' or None for all.
+        :param table: hourly index table, None to read it.
+        :return: pandas.Series (see read_hourly_air_quality_index) or None.
+        """
+        df = self.get_sites(typo=typo, table=table).dropna(subset=['lat', 'lon', 'iqa'])
+        if df.empty:
+            return None
+
+        # Haversine distance, enough to compare sites
+        lon1, lat1, lon2, lat2 = map(numpy.radians, (lon, lat, df['lon'].values, df['lat'].values))
+        a = numpy.sin((lat2 - lat1) / 2) ** 2 + \
+            numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+        return df.iloc[numpy.argmin(a)]
+
+    def get_hourly_air_quality_index(self, groupname):
+        """Return max of hourly index of urban and roadside sites of a borough.
+
+        :param groupname: borough name (e.g. 'cityoflondon').
+        :return: (max_urb, max_trf), 0 if no data.
+        """
+        return tuple(self.get_max_index(groupname, typo) or 0 for typo in ('urb', 'trf'))
+
+
+# Type of monitoring sites
+sitetypes = dict(urb='Urban', trf='Roadside')
+
+
+def london_to_utc(dt):
+    """Convert London local time to UTC.
+
+    British Summer Time (UTC+1) from the last Sunday of March to the last
+    Sunday of October, at 1:00 UTC (the hour around the change is approximate).
+
+    :param dt: datetime.datetime (naive, London time).
+    :return: datetime.datetime (naive, UTC).
+    """
+    def last_sunday(month):
+        d = datetime.datetime(dt.year, month, 31, 1)  # March and October have 31 days
+        return d - datetime.timedelta(days=(d.weekday() + 1) % 7)
+
+    if last_sunday(3) <= dt < last_sunday(10):
+        return dt - datetime.timedelta(hours=1)
+    return dt
+
+
+def boroughname(name):
+    """Normalize a borough name ('City of London' -> 'cityoflondon')."""
+    return re.sub('[^a-z0-9]', '', name.lower())
+
+
+def _as_list(e):
+    """Nested JSON from API has a dict instead of a list for a single element."""
+    if e is None:
+        return []
+    if isinstance(e, dict):
+        return [e, ]
+    return e
+
+
+def _as_float(s):
+    """Convert string from API to float (NaN if empty)."""
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return float('nan')
 
 
 def londoncolor(idx):
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Per-request profiling (operator only)."""
+
+
+import io
+import os
+import re
+import hmac
+import time
+import random
+import pstats
+import cProfile
+import datetime
+
+
+class ProfilerMiddleware(object):
+    """WSGI middleware running some requests under cProfile.
+
+    A request is profiled when:
+      - it has the header 'X-Apiair-Profile' with the secret as value: the
+        response is replaced by the profile report (text) and the profile
+        is saved,
+      - or it is sampled (see 'sample') and the profile is saved only if the
+        request took more than 'threshold' seconds.
+
+    Saved profiles (pstats format) are kept into 'directory', only the last
+    'maxprofiles' files are kept.
+    """
+
+    header = 'HTTP_X_APIAIR_PROFILE'
+
+    def __init__(self, app, directory, secret=None, threshold=None, sample=.01, maxprofiles=20, nlines=40):
+        """Constructor.
+
+        :param app: WSGI application.
+        :param directory: directory where profiles are saved.
+        :param secret: value of header to profile a request (None: disabled).
+        :param threshold: latency (seconds) above which a sampled request is saved (None: disabled).
+        :param sample: fraction of requests profiled for slow requests (from 0 to 1).
+        :param maxprofiles: number of profiles kept into directory (at least 1).
+        :param nlines: number of lines in the profile report.
+        """
+        if maxprofiles < 1:
+            raise ValueError("maxprofiles must be at least 1, got {}".format(maxprofiles))
+        self.app = app
+        self.directory = directory
+        self.secret = secret.encode('utf-8') if secret else None
+        self.threshold = threshold
+        self.sample = sample
+        self.maxprofiles = maxprofiles
+        self.nlines = nlines
+
+    def _is_forced(self, environ):
+        """Check the secret header of request."""
+        if self.secret is None or self.header not in environ:
+            return False
+        value = environ[self.header].encode('utf-8', 'surrogateescape')
+        return hmac.compare_digest(value, self.secret)
+
+    def _save(self, prof, environ, elapsed):
+        """Save profile and remove oldest ones.
+
+        :return: name of profile file.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        path = re.sub('[^A-Za-z0-9_.,-]+', '_', environ.get('PATH_INFO', '')).strip('_')
+        name = '{now:%Y%m%d-%H%M%S-%f}-{pid}-{ms:.0f}ms-{path}.prof'.format(
+            now=datetime.datetime.now(), pid=os.getpid(), ms=elapsed * 1000, path=path[:80])
+        prof.dump_stats(os.path.join(self.directory, name))
+
+        # Keep only the last profiles
+        fns = sorted(e for e in os.listdir(self.directory) if e.endswith('.prof'))
+        for fn in fns[:max(len(fns) - self.maxprofiles, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, fn))
+            except FileNotFoundError:  # already removed by another worker
+                pass
+
+        return name
+
+    def __call__(self, environ, start_response):
+        forced = self._is_forced(environ)
+        sampled = self.threshold is not None and random.random() < self.sample
+        if not forced and not sampled:
+            return self.app(environ, start_response)
+
+        response, body = dict(), list()
+
+        def catch_start_response(status, headers, exc_info=None):
+            response.update(status=status, headers=headers, exc_info=exc_info)
+            return body.append
+
+        def run():
+            appiter = self.app(environ, catch_start_response)
+            try:
+                body.extend(appiter)
+            finally:
+                if hasattr(appiter, 'close'):
+                    appiter.close()
+
+        prof = cProfile.Profile()
+        t0 = time.time()
+        prof.runcall(run)
+        elapsed = time.time() - t0
+
+        name = None
+        if forced or elapsed >= self.threshold:
+            name = self._save(prof, environ, elapsed)
+
+        if forced:
+            s = io.StringIO()
+            s.write('{} {} ({}): {:.3f} s\n\n'.format(
+                environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), response.get('status'), elapsed))
+            pstats.Stats(prof, stream=s).sort_stats('cumulative').print_stats(self.nlines)
+            out = s.getvalue().encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                      ('Content-Length', str(len(out))),
+                                      ('X-Apiair-Profile-Id', name)])
+            return [out]
+
+        start_response(response['status'], response['headers'], response['exc_info'])
+        return body
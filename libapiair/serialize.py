@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""Fast JSON serialization of NumPy/pandas data."""
+
+
+import json
+import math
+import datetime
+import numpy
+import pandas
+
+
+# Format des dates
+datefmt = '%Y-%m-%d %H:%M:%S'
+
+# Les flottants ayant au plus 'decimals' décimales (et |x| < 1e9) sont écrits
+# exactement par l'encodeur de pandas avec 15 décimales
+decimals = 6
+
+
+class RawJSON(object):
+    """Data already encoded in JSON, written as is by dumps."""
+
+    def __init__(self, data):
+        """Constructor.
+
+        :param data: JSON (bytes or string).
+        """
+        self.data = data.encode('utf-8') if isinstance(data, str) else data
+
+
+def _dumps_array(arr):
+    """Encode a NumPy array or a pandas Series as a JSON list."""
+    if isinstance(arr, pandas.Index):
+        if isinstance(arr, pandas.DatetimeIndex):
+            arr = arr.strftime(datefmt)
+        arr = pandas.Series(arr)
+    elif isinstance(arr, numpy.ndarray):
+        if arr.ndim != 1:
+            return b'[' + b','.join(_dumps_array(e) for e in arr) + b']'
+        arr = pandas.Series(arr)
+    if arr.dtype.kind == 'M':
+        arr = arr.dt.strftime(datefmt)
+    elif arr.dtype.kind == 'f':
+        arr = arr.astype('float64')
+        values = arr.values[numpy.isfinite(arr.values)]
+        if not (numpy.all(numpy.round(values, decimals) == values) and numpy.all(numpy.abs(values) < 1e9)):
+            # Too many digits for the pandas encoder (rounds to 15 decimal places):
+            # repr, same as json, NaN and infinity as null
+            return ('[' + ','.join([repr(e) if math.isfinite(e) else 'null' for e in arr.tolist()]) +
+                    ']').encode('utf-8')
+    elif arr.dtype.kind not in 'biu':
+        return b'[' + b','.join(dumps(e) for e in arr.tolist()) + b']'
+
+    # pandas encoder (C): one pass, NaN and infinity as null
+    return arr.to_json(orient='values', double_precision=15).encode('utf-8')
+
+
+def dumps(obj):
+    """Encode data into JSON.
+
+    NumPy arrays, pandas Series/Index are encoded in one pass by the pandas
+    encoder (no Python objects), NaN and infinity as null, dates with datefmt.
+    Floats with more than 'decimals' decimals are written with repr (same as
+    json). Keys of dict are sorted (same as flask.jsonify).
+
+    :param obj: data.
+    :return: bytes.
+    """
+    if isinstance(obj, RawJSON):
+        return obj.data
+    if isinstance(obj, dict):
+        return b'{' + b','.join(json.dumps(str(k)).encode('utf-8') + b':' + dumps(v)
+                                for k, v in sorted(obj.items())) + b'}'
+    if isinstance(obj, (list, tuple)):
+        return b'[' + b','.join(dumps(e) for e in obj) + b']'
+    if isinstance(obj, (numpy.ndarray, pandas.Series, pandas.Index)):
+        return _dumps_array(obj)
+    if isinstance(obj, numpy.generic):
+        obj = obj.item()
+    if obj is None or obj is pandas.NaT or (isinstance(obj, float) and not math.isfinite(obj)):
+        return b'null'
+    if isinstance(obj, datetime.datetime):
+        obj = obj.strftime(datefmt)
+    return json.dumps(obj).encode('utf-8')
+
+
+if __name__ == '__main__':
+
+    # Testing code: compare dumps with json.dumps
+
+    nan, inf = float('nan'), float('inf')
+
+    def check(obj, expected):
+        """Check that dumps(obj) decodes as expected (json.dumps of expected)."""
+        out = dumps(obj).decode('utf-8')
+        assert json.loads(out) == json.loads(json.dumps(expected)), (out, expected)
+
+    # Floats written by the pandas encoder are exact
+    rng = numpy.random.RandomState(0)
+    for e in range(-6, 9):
+        for d in range(0, decimals + 1):
+            x = numpy.round(rng.uniform(-1, 1, 10000) * 10. ** e, d)
+            check(x, x.tolist())
+
+    # Floats with many digits (repr), NaN and infinity
+    x = [0.1 + 0.2, 1 / 3, 1e-20, 123456789.123456789, 1e17, 26.125, 7.]
+    check(numpy.array(x), x)
+    check(pandas.Series(x + [nan, inf, -inf]), x + [None, None, None])
+    check(numpy.array([1.5, nan, inf, -inf]), [1.5, None, None, None])
+    check(numpy.array([1.1, 2.5], dtype='float32'), numpy.array([1.1, 2.5], dtype='float32').tolist())
+    check(numpy.array([], dtype='float64'), [])
+
+    # Integers and booleans
+    check(numpy.arange(5), [0, 1, 2, 3, 4])
+    check(pandas.Series([True, False]), [True, False])
+
+    # Dates
+    idx = pandas.date_range('2016-09-07 01:00', periods=3, freq='h')
+    dates = ['2016-09-07 01:00:00', '2016-09-07 02:00:00', '2016-09-07 03:00:00']
+    check(idx, dates)
+    check(pandas.Series(idx), dates)
+    check(pandas.Series([idx[0], pandas.NaT]), [dates[0], None])
+    check(datetime.datetime(2016, 9, 7, 1), dates[0])
+    check(pandas.NaT, None)
+
+    # Object arrays, 2-D arrays
+    check(numpy.array(['N2CINQ', None, nan, 1.5], dtype=object), ['N2CINQ', None, None, 1.5])
+    check(pandas.Series(['a"b', 'é']), ['a"b', 'é'])
+    check(numpy.array([[1., nan], [0.1 + 0.2, 4.]]), [[1., None], [0.1 + 0.2, 4.]])
+    check(numpy.zeros((2, 0)), [[], []])
+
+    # Scalars, RawJSON, nested data
+    check(numpy.float64(81.67), 81.67)
+    check(numpy.float64(nan), None)
+    check(numpy.int64(3), 3)
+    check(nan, None)
+    check(RawJSON('["2016-09-07 01:00:00"]'), dates[:1])
+    check(RawJSON(b'{"a": 1}'), {'a': 1})
+    check(dict(status='ok', index=RawJSON(json.dumps(dates)), data=dict(N2CINQ=numpy.array([7., nan]))),
+          dict(status='ok', index=dates, data=dict(N2CINQ=[7., None])))
+    check(dict(color=[(255, 0, 0)], iqa=[numpy.float64(0.5)], concentrations=[dict(NO2=26., O3=None)]),
+          dict(color=[[255, 0, 0]], iqa=[0.5], concentrations=[dict(NO2=26., O3=None)]))
+    assert dumps(dict(b=1, a=2)) == b'{"a":2,"b":1}'  # sorted keys
+
+    print('ok')